@@ -2,14 +2,16 @@ import numpy as np
 
 
 def mesh3d(x, y, z, dtype=np.float32):
-    grid = np.empty(x.shape + y.shape + z.shape + (3,), dtype=dtype)
-    #np.empty产生随机矩阵
-    #x.shape返回(x,y)类型
+    # cast the 1D inputs so the stacked grid is created with `dtype` directly
+    x, y, z = (np.asarray(a, dtype=dtype) for a in (x, y, z))
+    shape = x.shape + y.shape + z.shape
+    #np.broadcast_to产生只读视图，不复制数据
     #np.newaxis增加一个维度
-    grid[..., 0] = x[:, np.newaxis, np.newaxis]
-    grid[..., 1] = y[np.newaxis, :, np.newaxis]
-    grid[..., 2] = z[np.newaxis, np.newaxis, :]
-    return grid
+    xb = np.broadcast_to(x[:, np.newaxis, np.newaxis], shape)
+    yb = np.broadcast_to(y[np.newaxis, :, np.newaxis], shape)
+    zb = np.broadcast_to(z[np.newaxis, np.newaxis, :], shape)
+    #np.stack一次性写出 (X, Y, Z, 3) 网格
+    return np.stack([xb, yb, zb], axis=-1)
 
 
 def extent(x, *args, **kwargs):
@@ -1,4 +1,6 @@
+import os
 import numpy as np
+import tensorflow as tf
 
 
 def get_image_dataset(cat_ids, example_ids, view_indices, render_config=None):
@@ -25,7 +27,7 @@ def get_image_dataset(cat_ids, example_ids, view_indices, render_config=None):
 
 
 def get_cloud_dataset(cat_ids, example_ids, n_samples=16384, n_resamples=1024):
-    import os
+    """If `n_resamples` is None, the full `n_samples` cloud is returned."""
     from shapenet.core.point_clouds import PointCloudAutoSavingManager
     from util3d.point_cloud import sample_points
     from dids.core import BiKeyDataset
@@ -39,10 +41,234 @@ def get_cloud_dataset(cat_ids, example_ids, n_samples=16384, n_resamples=1024):
             manager.save_all()
         datasets[cat_id] = manager.get_saving_dataset(
             mode='r').subset(e_ids)
+    if n_resamples is None:
+        return BiKeyDataset(datasets).map(
+            lambda x: np.array(x, dtype=np.float32))
     return BiKeyDataset(datasets).map(
         lambda x: sample_points(np.array(x, dtype=np.float32), n_resamples))
 
 
+_records_dir = os.path.join(os.path.realpath(os.path.dirname(__file__)),
+                            '_records')
+
+
+# incremented whenever the record format changes
+_records_version = 2
+
+
+def _get_view_subdir(view_index):
+    if isinstance(view_index, int):
+        view_index = [view_index]
+    return 'v%s' % '-'.join(str(v) for v in view_index)
+
+
+def get_records_dir(
+        render_config, view_index, n_samples, cat_id, example_ids, mode):
+    import hashlib
+    if mode in ('predict', 'infer'):
+        mode = 'eval'
+    # keyed by example ids so records aren't reused if the split changes
+    ids_hash = hashlib.md5(
+        '\n'.join(sorted(example_ids)).encode()).hexdigest()
+    return os.path.join(
+        _records_dir, render_config.config_id, _get_view_subdir(view_index),
+        's%d' % n_samples, cat_id,
+        '%s-%s-r%d' % (mode, ids_hash, _records_version))
+
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _bytes_list_feature(values):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=values))
+
+
+def _int64_list_feature(values):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
+
+def create_records(
+        render_config, view_index, n_samples, cat_id, example_ids, mode,
+        n_shards=8, overwrite=False):
+    """
+    Write images and full point clouds to sharded TFRecord files.
+
+    Each record is a `tf.train.Example` for a single (cat_id, example_id)
+    with `cat_id`, `example_id`, a list of `view_indices`, a list of raw
+    uint8 `images` bytes (one per view) and raw float32 `cloud` bytes of
+    shape `(n_samples, 3)`. The cloud is stored once regardless of the
+    number of views. Clouds are resampled in the input pipeline so each
+    epoch still sees a different subset of points.
+
+    Examples are shuffled before being distributed between shards. Records
+    are written to a temporary folder which is renamed once complete, so an
+    existing records folder is never partially written.
+    """
+    import random
+    import shutil
+    from progress.bar import IncrementalBar
+    folder = get_records_dir(
+        render_config, view_index, n_samples, cat_id, example_ids, mode)
+    if os.path.isdir(folder):
+        if not overwrite:
+            return
+        shutil.rmtree(folder)
+    tmp_folder = '%s.tmp' % folder
+    if os.path.isdir(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+
+    image_ds = get_image_dataset(
+        cat_id, example_ids, view_index, render_config)
+    cloud_ds = get_cloud_dataset(cat_id, example_ids, n_samples, None)
+    paths = [os.path.join(tmp_folder, 'shard-%03d-of-%03d.tfrecord'
+                          % (i, n_shards)) for i in range(n_shards)]
+    writers = [tf.io.TFRecordWriter(path) for path in paths]
+    try:
+        with image_ds, cloud_ds:
+            view_indices = {}
+            for c, example_id, v in image_ds.keys():
+                view_indices.setdefault((c, example_id), []).append(v)
+            keys = sorted(view_indices)
+            random.Random(0).shuffle(keys)
+            bar = IncrementalBar(
+                'Creating records for %s' % cat_id, max=len(keys))
+            for i, (c, example_id) in enumerate(keys):
+                views = sorted(view_indices[c, example_id])
+                images = [
+                    np.asarray(
+                        image_ds[c, example_id, v], dtype=np.uint8).tobytes()
+                    for v in views]
+                cloud = np.asarray(cloud_ds[c, example_id], dtype=np.float32)
+                example = tf.train.Example(features=tf.train.Features(
+                    feature=dict(
+                        cat_id=_bytes_feature(c.encode()),
+                        example_id=_bytes_feature(example_id.encode()),
+                        view_indices=_int64_list_feature(views),
+                        images=_bytes_list_feature(images),
+                        cloud=_bytes_feature(cloud.tobytes()))))
+                writers[i % n_shards].write(example.SerializeToString())
+                bar.next()
+            bar.finish()
+    finally:
+        for writer in writers:
+            writer.close()
+    os.rename(tmp_folder, folder)
+
+
+def get_records_paths(
+        render_config, view_index, n_samples, cat_ids, example_ids, mode):
+    """Get TFRecord shard paths, creating the records if necessary."""
+    if isinstance(cat_ids, str):
+        cat_ids = [cat_ids]
+        example_ids = [example_ids]
+    paths = []
+    for cat_id, e_ids in zip(cat_ids, example_ids):
+        create_records(
+            render_config, view_index, n_samples, cat_id, e_ids, mode)
+        folder = get_records_dir(
+            render_config, view_index, n_samples, cat_id, e_ids, mode)
+        paths.extend(sorted(
+            os.path.join(folder, fn) for fn in os.listdir(folder)))
+    return paths
+
+
+def _get_image_stats_path(render_config, view_index, cat_id):
+    return os.path.join(
+        _records_dir, render_config.config_id, _get_view_subdir(view_index),
+        '%s_image_stats.json' % cat_id)
+
+
+def _calculate_image_stats(render_config, view_index, cat_id, n_images):
+    import random
+    from progress.bar import IncrementalBar
+    from template_ffd.data.ids import get_example_ids
+    example_ids = list(get_example_ids(cat_id, 'train'))
+    random.Random(0).shuffle(example_ids)
+    example_ids = example_ids[:n_images]
+    image_ds = get_image_dataset(
+        cat_id, example_ids, view_index, render_config)
+    total = np.zeros((3,), dtype=np.float64)
+    total2 = np.zeros((3,), dtype=np.float64)
+    count = 0
+    with image_ds:
+        keys = list(image_ds.keys())
+        bar = IncrementalBar(
+            'Calculating image stats for %s' % cat_id, max=len(keys))
+        for key in keys:
+            image = np.asarray(image_ds[key], dtype=np.float64)
+            image = np.reshape(image, (-1, 3))
+            total += np.sum(image, axis=0)
+            total2 += np.sum(image**2, axis=0)
+            count += image.shape[0]
+            bar.next()
+        bar.finish()
+    return dict(
+        mean=list(total / count), mean2=list(total2 / count), count=count)
+
+
+def get_image_stats(render_config, view_index, cat_ids, n_images=1000):
+    """
+    Get per-channel (mean, std) of training images.
+
+    Statistics are calculated over a fixed sample of up to `n_images`
+    training examples per category and cached alongside the records.
+    """
+    import json
+    if isinstance(cat_ids, str):
+        cat_ids = [cat_ids]
+    mean = np.zeros((3,), dtype=np.float64)
+    mean2 = np.zeros((3,), dtype=np.float64)
+    count = 0
+    for cat_id in cat_ids:
+        path = _get_image_stats_path(render_config, view_index, cat_id)
+        if os.path.isfile(path):
+            with open(path, 'r') as fp:
+                stats = json.load(fp)
+        else:
+            stats = _calculate_image_stats(
+                render_config, view_index, cat_id, n_images)
+            folder = os.path.dirname(path)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            with open(path, 'w') as fp:
+                json.dump(stats, fp)
+        n = stats['count']
+        mean += n * np.array(stats['mean'])
+        mean2 += n * np.array(stats['mean2'])
+        count += n
+    mean /= count
+    mean2 /= count
+    std = np.sqrt(mean2 - mean**2)
+    return mean.astype(np.float32), std.astype(np.float32)
+
+
+def parse_record(serialized, image_shape, n_samples):
+    """
+    Parse a record written by `create_records`.
+
+    Returns (cat_id, example_id, view_indices, images, cloud), where
+    `view_indices` has shape (V,), `images` (V,) + image_shape and `cloud`
+    (n_samples, 3).
+    """
+    features = tf.io.parse_single_example(serialized, dict(
+        cat_id=tf.io.FixedLenFeature((), tf.string),
+        example_id=tf.io.FixedLenFeature((), tf.string),
+        view_indices=tf.io.VarLenFeature(tf.int64),
+        images=tf.io.VarLenFeature(tf.string),
+        cloud=tf.io.FixedLenFeature((), tf.string)))
+    images = tf.sparse.to_dense(features['images'], default_value='')
+    images = tf.reshape(
+        tf.io.decode_raw(images, tf.uint8), (-1,) + tuple(image_shape))
+    view_indices = tf.cast(
+        tf.sparse.to_dense(features['view_indices']), tf.int32)
+    cloud = tf.reshape(
+        tf.io.decode_raw(features['cloud'], tf.float32), (n_samples, 3))
+    return features['cat_id'], features['example_id'], view_indices, \
+        images, cloud
+
+
 if __name__ == '__main__':
     from shapenet.core import cat_desc_to_id
     from template_ffd.data.ids import get_example_ids
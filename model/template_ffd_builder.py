@@ -1,3 +1,5 @@
+import os
+import contextlib
 import itertools
 import numpy as np
 import tensorflow as tf
@@ -5,8 +7,16 @@ from shapenet.core import cat_desc_to_id
 import builder
 from template_ffd.metrics.tf_impl import tf_metrics
 from template_ffd.templates.ffd import get_ffd_dataset
+from template_ffd.templates.path import get_ffd_cache_path, \
+    get_ffd_group_path
 from template_ffd.data.ids import get_example_ids
 from template_ffd.templates.mesh import get_template_mesh_dataset
+from template_ffd.templates.ids import get_template_ids
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
 
 def add_update_ops(ops):
@@ -31,38 +41,105 @@ def add_update_ops(ops):
 
 
 def _get_cat_template_ids(cat_id, template_idxs):
-    from template_ffd.templates.ids import get_template_ids
     template_ids = get_template_ids(cat_id)
     if template_idxs is not None:
         template_ids = tuple(template_ids[i] for i in template_idxs)
     return tuple((cat_id, t) for t in template_ids)
 
 
-def get_nn(data, query_points):
-    from scipy.spatial import cKDTree
-    tree = cKDTree(data)
-    return tree.query(query_points)[1]
+def get_nn(data, query_points, tree=None):
+    """
+    Get indices of the nearest points in `data` to each of `query_points`.
+
+    If `tree` is given it must be a `cKDTree` built on `data` and is reused
+    rather than being rebuilt. Queries are spread across all cores.
+    """
+    if tree is None:
+        from scipy.spatial import cKDTree
+        tree = cKDTree(data)
+    try:
+        return tree.query(query_points, k=1, workers=-1)[1]
+    except TypeError:
+        # scipy < 1.6
+        return tree.query(query_points, k=1, n_jobs=-1)[1]
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _centroids(vertices, faces, out):
+        # fused gather + mean, avoids the (F, 3, 3) vertices[faces] temporary
+        for i in prange(faces.shape[0]):
+            a = faces[i, 0]
+            b = faces[i, 1]
+            c = faces[i, 2]
+            for j in range(3):
+                out[i, j] = (
+                    vertices[a, j] + vertices[b, j] + vertices[c, j]) / 3
 
 
 def get_centroids(vertices, faces):
-    return np.mean(vertices[faces], axis=-2)
+    if njit is None:
+        return np.mean(vertices[faces], axis=-2)
+    vertices = np.ascontiguousarray(vertices)
+    faces = np.ascontiguousarray(faces)
+    out = np.empty((faces.shape[0], 3), dtype=vertices.dtype)
+    _centroids(vertices, faces, out)
+    return out
 
 
-def segment_faces(vertices, faces, points, labels):
-    from shapenet.core.annotations import segment
+def get_face_labels(vertices, faces, points, labels, tree=None):
+    """Get the label of the nearest labelled point to each face centroid."""
     centroids = get_centroids(vertices, faces)
-    i0 = get_nn(points, centroids)
-    face_labels = labels[i0]
+    return labels[get_nn(points, centroids, tree=tree)]
+
+
+def segment_faces(vertices, faces, points, labels, tree=None):
+    from shapenet.core.annotations import segment
+    face_labels = get_face_labels(vertices, faces, points, labels, tree=tree)
     assert(len(face_labels) == len(faces))
     segmented_faces = segment(faces, face_labels)
     return segmented_faces
 
 
-def sample_tf(x, n_resamples, axis=0, name=None):
+def stack_if_uniform(arrays):
+    """
+    Stack `arrays` into a single contiguous array if they share a shape.
+
+    Otherwise `arrays` is returned as a tuple. Either way the result can be
+    indexed by template index.
+    """
+    arrays = tuple(arrays)
+    if len(set(a.shape for a in arrays)) == 1:
+        return np.stack(arrays)
+    return arrays
+
+
+def sample_tf(x, n_resamples, axis=0, batch_dims=0, name=None):
+    """
+    Resample `x` along `axis` with replacement.
+
+    The first `batch_dims` dimensions are treated as batch dimensions, each
+    with independently sampled indices.
+
+    Indices are drawn with a stateless RNG seeded by the global step and
+    `name`, so there is no stateful op in the graph and samples are
+    reproducible for a given step.
+
+    Note the global step is constant during evaluation, so every batch of
+    an evaluation run uses the same resampled indices (different runs at
+    different checkpoints still differ). Eval losses are hence computed on
+    a fixed subsample rather than a fresh one per batch.
+    """
+    import zlib
     n_original = x.shape[axis]
-    indices = tf.random_uniform(
-        shape=(n_resamples,), minval=0, maxval=n_original, dtype=np.int32)
-    return tf.gather(x, indices, axis=axis, name=name)
+    shape = tuple(x.shape.as_list()[:batch_dims]) + (n_resamples,)
+    step = tf.train.get_or_create_global_step()
+    salt = zlib.crc32(str(name).encode()) & 0xffff
+    seed = tf.stack([step, tf.constant(salt, dtype=step.dtype)])
+    indices = tf.random.stateless_uniform(
+        shape=shape, seed=seed, minval=0, maxval=n_original, dtype=tf.int32)
+    return tf.gather(
+        x, indices, axis=axis, batch_dims=batch_dims, name=name)
 
 
 def batch_norm_then(activation, **bn_kwargs):
@@ -71,6 +148,16 @@ def batch_norm_then(activation, **bn_kwargs):
     return f
 
 
+@contextlib.contextmanager
+def jit_scope(enabled=True):
+    """`tf.xla.experimental.jit_scope` if `enabled`, otherwise a no-op."""
+    if enabled:
+        with tf.xla.experimental.jit_scope():
+            yield
+    else:
+        yield
+
+
 def get_mobilenet_features(image, mode, load_weights=False, alpha=1):
     from mobilenet import MobileNet
     training = mode == tf.estimator.ModeKeys.TRAIN
@@ -87,56 +174,90 @@ def get_mobilenet_features(image, mode, load_weights=False, alpha=1):
     return model.output
 
 
-def linear_annealing_factor(cutoff):
-    step = tf.cast(tf.train.get_or_create_global_step(), tf.float32)
+def get_float_step():
+    return tf.cast(tf.train.get_or_create_global_step(), tf.float32)
+
+
+def linear_annealing_factor(cutoff, step=None):
+    if step is None:
+        step = get_float_step()
     return tf.maximum(1 - step / cutoff, 0)
 
 
-def exp_annealing_factor(rate):
-    step = tf.cast(tf.train.get_or_create_global_step(), tf.float32)
+def exp_annealing_factor(rate, step=None):
+    if step is None:
+        step = get_float_step()
     return tf.exp(-step*rate)
 
 
 def annealed_weight(
-        weight, linear_annealing_cutoff=None, exp_annealing_rate=None):
+        weight, linear_annealing_cutoff=None, exp_annealing_rate=None,
+        step=None):
+    """
+    Get `weight` annealed according to the global step.
+
+    `step`, if given, should be the float32 global step, e.g. from
+    `get_float_step`, so it can be shared between multiple weights.
+    """
     if linear_annealing_cutoff is None:
         if exp_annealing_rate is None:
             return weight
-        return weight*exp_annealing_factor(exp_annealing_rate)
+        return weight*exp_annealing_factor(exp_annealing_rate, step)
     else:
         if exp_annealing_rate is None:
-            return weight*linear_annealing_factor(linear_annealing_cutoff)
+            return weight*linear_annealing_factor(
+                linear_annealing_cutoff, step)
         else:
             raise ValueError(
                 'At least one of `linear_annealing_cutoff` or '
                 '`exp_annealing_rate` must be `None`')
 
 
+def standardize_image(image, image_stats=None):
+    """
+    Standardize a uint8 image.
+
+    Uses `tf.image.per_image_standardization` if `image_stats` is None,
+    otherwise the fixed per-channel `(mean, std)` in `image_stats`.
+    """
+    if image_stats is None:
+        return tf.image.per_image_standardization(image)
+    # fixed dataset statistics, no per-image reductions
+    mean, std = image_stats
+    return (tf.cast(image, tf.float32) - mean) * (1. / std)
+
+
 def get_dataset(
         render_config, view_index, n_samples, n_resamples, cat_id,
-        example_ids, num_parallel_calls=8, shuffle=False, repeat=False,
-        batch_size=None):
-    from .data import get_image_dataset, get_cloud_dataset
-
-    # image_ds = get_image_dataset(render_config, cat_id, view_index)
-    image_ds = get_image_dataset(
-        cat_id, example_ids, view_index, render_config)
-    cloud_ds = get_cloud_dataset(cat_id, example_ids, n_samples, n_resamples)
-    image_ds.open()
-    cloud_ds.open()
-
-    def map_np(cat_id, example_id, view_index):
-        image = image_ds[cat_id, example_id, view_index]
-        cloud = cloud_ds[cat_id, example_id]
-        return image, cloud
-
-    def map_tf(cat_id, example_id, view_index):
-        image, cloud = tf.py_func(
-            map_np, [cat_id, example_id, view_index],
-            (tf.uint8, tf.float32), stateful=False)
-        image.set_shape(tuple(render_config.shape) + (3,))
+        example_ids, mode, num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        shuffle=False, repeat=False, batch_size=None,
+        shuffle_buffer_size=1024, prefetch_device=None, image_stats=None):
+    from .data import get_records_paths, parse_record
+
+    # decoding happens in native ops on TFRecord shards rather than a
+    # `tf.py_func`, so `num_parallel_calls` isn't serialized by the GIL
+    paths = get_records_paths(
+        render_config, view_index, n_samples, cat_id, example_ids, mode)
+    image_shape = tuple(render_config.shape) + (3,)
+
+    def parse_tf(serialized):
+        return parse_record(serialized, image_shape, n_samples)
+
+    def expand_views(cat_id, example_id, view_indices, images, cloud):
+        # one element per view, sharing the example's single stored cloud
+        n_views = tf.shape(view_indices, out_type=tf.int64)[0]
+        return tf.data.Dataset.zip((
+            tf.data.Dataset.from_tensors(cat_id).repeat(n_views),
+            tf.data.Dataset.from_tensors(example_id).repeat(n_views),
+            tf.data.Dataset.from_tensor_slices(view_indices),
+            tf.data.Dataset.from_tensor_slices(images),
+            tf.data.Dataset.from_tensors(cloud).repeat(n_views)))
+
+    def map_tf(cat_id, example_id, view_index, image, cloud):
+        indices = tf.random_shuffle(tf.range(n_samples))[:n_resamples]
+        cloud = tf.gather(cloud, indices)
         cloud.set_shape((n_resamples, 3))
-        image = tf.image.per_image_standardization(image)
+        image = standardize_image(image, image_stats)
         features = dict(
             image=image,
             cat_id=cat_id,
@@ -145,35 +266,73 @@ def get_dataset(
 
         return features, cloud
 
-    cat_ids, example_ids, view_indices = zip(*image_ds.keys())
-    n_examples = len(cat_ids)
-    cat_ids = tf.convert_to_tensor(cat_ids, tf.string)
-    example_ids = tf.convert_to_tensor(example_ids, tf.string)
-    view_indices = tf.convert_to_tensor(view_indices, tf.int32)
-
     dataset = tf.data.Dataset.from_tensor_slices(
-        (cat_ids, example_ids, view_indices))
+        tf.convert_to_tensor(paths, tf.string))
     if shuffle:
-        dataset = dataset.shuffle(buffer_size=n_examples)
+        dataset = dataset.shuffle(buffer_size=len(paths))
     if repeat:
         dataset = dataset.repeat()
 
+    dataset = dataset.interleave(
+        tf.data.TFRecordDataset, cycle_length=len(paths),
+        num_parallel_calls=num_parallel_calls)
+    dataset = dataset.map(parse_tf, num_parallel_calls=num_parallel_calls)
+    dataset = dataset.flat_map(expand_views)
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size=shuffle_buffer_size)
+
     dataset = dataset.map(
         map_tf, num_parallel_calls=num_parallel_calls)
 
     if batch_size is not None:
         dataset = dataset.batch(batch_size)
 
-    dataset = dataset.prefetch(2)
-    # dataset = dataset.apply(tf.contrib.data.prefetch_to_device('/gpu:0'))
+    options = tf.data.Options()
+    options.experimental_optimization.map_and_batch_fusion = True
+    if hasattr(options.experimental_optimization, 'parallel_batch'):
+        # only available in newer tensorflow versions
+        options.experimental_optimization.parallel_batch = True
+    # element order only matters when not shuffling
+    options.experimental_deterministic = not shuffle
+    dataset = dataset.with_options(options)
+
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+    if prefetch_device is not None:
+        # keep the next batch resident on the device so the host-to-device
+        # copy is off the training step's critical path
+        dataset = dataset.apply(
+            tf.data.experimental.copy_to_device(prefetch_device))
+        with tf.device(prefetch_device):
+            dataset = dataset.prefetch(2)
 
     return dataset
 
 
+ITERATOR_INITIALIZERS = 'template_ffd_iterator_initializers'
+
+
+class IteratorInitializerHook(tf.train.SessionRunHook):
+    """
+    Runs initializers of iterators created by `TemplateFfdBuilder.get_inputs`.
+
+    Only required when `prefetch_device` is set. Sessions not created by the
+    estimator must be given this hook explicitly.
+    """
+    def begin(self):
+        self._initializers = tf.get_collection(ITERATOR_INITIALIZERS)
+
+    def after_create_session(self, session, coord):
+        if self._initializers:
+            session.run(self._initializers)
+
+
 class TemplateFfdBuilder(builder.ModelBuilder):
     def __init__(self, *args, **kwargs):
         super(TemplateFfdBuilder, self).__init__(*args, **kwargs)
         self._initializer_run = False
+        self._template_ids = None
+        self._image_stats = None
+        self._image_stats_loaded = False
 
     @property
     def n_ffd_samples(self): #采样点数16384
@@ -184,33 +343,91 @@ class TemplateFfdBuilder(builder.ModelBuilder):
         return self.params.get('view_index', 5)
 
     def _get_ffd_data(self, ffd_dataset):# 返回 类别，序号，伯恩斯坦多项式，控制点
-        for cat_id, example_id in self.template_ids:
-            ffd_data = ffd_dataset[cat_id, example_id]
-            b, p = (np.array(ffd_data[k]) for k in ('b', 'p'))
+        b, p, offsets = self._read_ffd_arrays(ffd_dataset)
+        bs = (b[i:j] for i, j in zip(offsets[:-1], offsets[1:]))
+        for (cat_id, example_id), b, p in zip(self.template_ids, bs, p):
             yield cat_id, example_id, b, p
 
-    def get_ffd_data(self, ffd_dataset=None):# 返回ffd的data数据
-        if ffd_dataset is None:
-            n_ffd_points = self.n_ffd_samples
+    def _ffd_cache_path(self, edge_length_threshold=None, n_samples=None):
+        import hashlib
+        key = repr(
+            (self.template_ids, self.n, edge_length_threshold, n_samples))
+        return get_ffd_cache_path(
+            self.n, hashlib.md5(key.encode()).hexdigest())
+
+    def _read_ffd_arrays(self, ffd_dataset):
+        """
+        Read ffd data for all templates into preallocated SoA buffers.
+
+        Returns:
+            b: (sum(N_i), K) float32 deformation matrices, concatenated.
+            p: (T, K, 3) float32 control points.
+            offsets: (T+1,) start/end indices of each template's rows in b.
+        """
+        groups = [ffd_dataset[k] for k in self.template_ids]
+        offsets = np.cumsum([0] + [g['b'].shape[0] for g in groups])
+        n_control_points = self.n_control_points
+        b = np.empty((offsets[-1], n_control_points), dtype=np.float32)
+        p = np.empty((len(groups), n_control_points, 3), dtype=np.float32)
+        for i, g in enumerate(groups):
+            g['b'].read_direct(b, dest_sel=np.s_[offsets[i]:offsets[i+1]])
+            g['p'].read_direct(p, dest_sel=np.s_[i])
+        return b, p, offsets
+
+    def _load_ffd_data(self, edge_length_threshold=None, n_samples=None):
+        """
+        Get ffd data for all templates, cached in a single `.npz` file.
+
+        Deformation matrices are saved concatenated along the first axis
+        along with offsets, since they may differ in size between templates.
+        The cache is rebuilt if any of the source hdf5 files are newer.
+        """
+        path = self._ffd_cache_path(edge_length_threshold, n_samples)
+        cat_ids = self.cat_id
+        if isinstance(cat_ids, str):
+            cat_ids = [cat_ids]
+        source_paths = [get_ffd_group_path(
+            c, self.n, edge_length_threshold, n_samples) for c in cat_ids]
+        if os.path.isfile(path) and all(
+                os.path.getmtime(sp) <= os.path.getmtime(path)
+                for sp in source_paths if os.path.isfile(sp)):
+            with np.load(path) as data:
+                b, p, offsets = (data[k] for k in ('b', 'p', 'offsets'))
+        else:
             ffd_dataset = get_ffd_dataset(
-                self.cat_id, self.n, n_samples=n_ffd_points)
+                self.cat_id, self.n,
+                edge_length_threshold=edge_length_threshold,
+                n_samples=n_samples)
             with ffd_dataset:
-                return tuple(self._get_ffd_data(ffd_dataset))
+                b, p, offsets = self._read_ffd_arrays(ffd_dataset)
+            # write to a temporary file first so an interrupted write never
+            # leaves a truncated cache behind
+            tmp_path = '%s.tmp.npz' % os.path.splitext(path)[0]
+            np.savez(tmp_path, b=b, p=p, offsets=offsets)
+            os.rename(tmp_path, path)
+        bs = (b[i:j] for i, j in zip(offsets[:-1], offsets[1:]))
+        return tuple(
+            (cat_id, example_id, b, p) for (cat_id, example_id), b, p
+            in zip(self.template_ids, bs, p))
+
+    def get_ffd_data(self, ffd_dataset=None):# 返回ffd的data数据
+        if ffd_dataset is None:
+            return self._load_ffd_data(n_samples=self.n_ffd_samples)
         else:
             return self._get_ffd_data(ffd_dataset)
 
+    def get_mesh_ffd_data(self, edge_length_threshold=None):
+        """Get ffd data based on template mesh vertices."""
+        return self._load_ffd_data(edge_length_threshold=edge_length_threshold)
+
     def get_ffd_tensors(self, ffd_dataset=None):#获取ffd的tensors
         n_ffd_resamples = self.params.get('n_ffd_resamples', 1024) #重采样1024点
-        bs = []
-        ps = []
-        for cat_id, example_id, b, p in self.get_ffd_data(ffd_dataset):
-            b = tf.constant(b, dtype=tf.float32)
-            b = sample_tf(
-                b, n_ffd_resamples, axis=0, name='b_resampled_%s' % example_id) #1024采样
-            bs.append(b)
-            ps.append(p)
-        b = tf.stack(bs)
-        p = tf.constant(np.array(ps), dtype=tf.float32)
+        cat_ids, example_ids, bs, ps = zip(*self.get_ffd_data(ffd_dataset))
+        # resample all templates with a single gather, (T, N, K) -> (T, S, K)
+        b = tf.constant(np.stack(bs), dtype=tf.float32)
+        b = sample_tf(
+            b, n_ffd_resamples, axis=1, batch_dims=1, name='b_resampled') #1024采样
+        p = tf.constant(np.stack(ps), dtype=tf.float32)
 
         return b, p
 
@@ -221,6 +438,15 @@ class TemplateFfdBuilder(builder.ModelBuilder):
         conv_filters = inference_params.get('final_conv_filters', [64])
 
         use_bn_bug = self.params.get('use_bn_bugged_version', False)
+        # batch norm in the final conv layers historically never received
+        # the training flag, so never updated its moving statistics and
+        # behaved as a fixed affine transform kept for existing models.
+        # `train_final_bn` trains it as standard batch normalization.
+        if self.params.get('train_final_bn', False):
+            bn_training = mode == tf.estimator.ModeKeys.TRAIN
+        else:
+            bn_training = False
+
         if use_bn_bug:
             # double batch-norm was used in training for old models
             # this is here for backwards compatibility
@@ -231,15 +457,27 @@ class TemplateFfdBuilder(builder.ModelBuilder):
                     features, n, 1, activation=activation)
                 # EEEEEK
                 features = tf.layers.batch_normalization(features)
+        elif self.params.get('fuse_final_conv_bn', False):
+            # the conv bias is redundant before batch norm. Without it, and
+            # with fused batch norm in inference mode, grappler's remapper
+            # can fold Conv2D + FusedBatchNorm (CPU only in tensorflow 1).
+            # Changes the model variables, so only for newly trained models.
+            for n in conv_filters:
+                features = tf.layers.conv2d(features, n, 1, use_bias=False)
+                features = tf.layers.batch_normalization(
+                    features, fused=True, training=bn_training)
+                features = tf.nn.relu6(features)
         else:
             for n in conv_filters:
                 features = tf.layers.conv2d(features, n, 1)
-                features = tf.nn.relu6(tf.layers.batch_normalization(features))
+                features = tf.nn.relu6(tf.layers.batch_normalization(
+                    features, training=bn_training))
 
         return features
 
     def get_inference(self, features, mode):
-        """Get inferred value of the model."""获取模型的推测值
+        """Get inferred value of the model."""
+        #获取模型的推测值
         inference_params = self.params.get('inference_params', {})
         training = mode == tf.estimator.ModeKeys.TRAIN
         image = features['image']
@@ -293,6 +531,12 @@ class TemplateFfdBuilder(builder.ModelBuilder):
 
     @property
     def template_ids(self):
+        # computed once, params are not expected to change after construction
+        if self._template_ids is None:
+            self._template_ids = self._get_template_ids()
+        return self._template_ids
+
+    def _get_template_ids(self):
         cat_id = self.cat_id
         idxs = self.params.get('template_idxs')
         if isinstance(cat_id, str):
@@ -303,35 +547,74 @@ class TemplateFfdBuilder(builder.ModelBuilder):
             return tuple(itertools.chain(
                 *(_get_cat_template_ids(c, i) for c, i in zip(cat_id, idxs))))
 
-    def get_inferred_point_clouds(self, dp):#获取推断的新点云坐标
-        b, p = self.get_ffd_tensors()
-        inferred_point_clouds = tf.einsum('ijk,likm->lijm', b, p + dp)#全局关键语句，推测新点云位置
+    def get_inferred_point_clouds(self, dp, ffd_tensors=None):#获取推断的新点云坐标
+        b, p = self.get_ffd_tensors() if ffd_tensors is None else ffd_tensors
+        #全局关键语句，推测新点云位置
+        # equivalent to tf.einsum('ijk,likm->lijm', b, p + dp), but folds the
+        # batch dimension into the GEMM columns so it is a single batched
+        # matmul over templates.
+        n_templates, n_samples, n_control_points = b.shape.as_list()
+        batch_size = tf.shape(dp)[0]
+        bp = tf.transpose(p + dp, (1, 2, 0, 3))  # (T, K, L, 3)
+        bp = tf.reshape(bp, (n_templates, n_control_points, -1))
+        inferred_point_clouds = tf.matmul(b, bp)  # (T, S, L*3)
+        inferred_point_clouds = tf.reshape(
+            inferred_point_clouds, (n_templates, n_samples, batch_size, 3))
+        inferred_point_clouds = tf.transpose(
+            inferred_point_clouds, (2, 0, 1, 3))
         return inferred_point_clouds
 
     def get_chamfer_loss(self, gamma, dp, ground_truth_cloud):
-        inferred_point_clouds = self.get_inferred_point_clouds(dp)
-        inferred_point_clouds = tf.unstack(inferred_point_clouds, axis=1)
-        losses = [tf_metrics.chamfer(inferred, ground_truth_cloud)
-                  for inferred in inferred_point_clouds]
-        losses = tf.stack(losses, axis=1)
+        # resampling reads the global step variable, so stays outside XLA
+        ffd_tensors = self.get_ffd_tensors()
+        use_xla = self.params.get('use_xla_loss', False)
+        chamfer_dtype = self.params.get('chamfer_matmul_dtype')
+
+        with jit_scope(use_xla):
+            inferred_point_clouds = self.get_inferred_point_clouds(
+                dp, ffd_tensors)
+            # fold templates into the batch dimension for a single chamfer op
+            n_templates, n_samples = \
+                inferred_point_clouds.shape.as_list()[1:3]
+            n_gt = ground_truth_cloud.shape.as_list()[1]
+            inferred_point_clouds = tf.reshape(
+                inferred_point_clouds, (-1, n_samples, 3))
+            ground_truth_cloud = tf.tile(
+                tf.expand_dims(ground_truth_cloud, axis=1),
+                (1, n_templates, 1, 1))
+            ground_truth_cloud = tf.reshape(
+                ground_truth_cloud, (-1, n_gt, 3))
+
+        if chamfer_dtype is None:
+            # custom nn_distance op has no XLA kernel
+            losses = tf_metrics.chamfer(
+                inferred_point_clouds, ground_truth_cloud)
+        else:
+            with jit_scope(use_xla):
+                losses = tf_metrics.matmul_chamfer(
+                    inferred_point_clouds, ground_truth_cloud,
+                    dtype=tf.as_dtype(chamfer_dtype))
+
+        losses = tf.reshape(losses, (-1, n_templates))
         losses = gamma * losses
         loss = tf.reduce_sum(losses)
         return loss
 
-    def get_entropy_loss(self, probs, **weight_kwargs):
+    def get_entropy_loss(self, probs, step=None, **weight_kwargs):
+        probs = tf.cast(probs, tf.float32)
         mean_probs = tf.reduce_mean(probs, axis=0)  # average across batch
         entropy_loss = tf.reduce_sum(mean_probs * tf.log(mean_probs))
-        weight = annealed_weight(**weight_kwargs)
+        weight = annealed_weight(step=step, **weight_kwargs)
         return entropy_loss * weight
 
-    def get_dp_reg_loss(self, probs, dp, **weight_kwargs):
+    def get_dp_reg_loss(self, probs, dp, step=None, **weight_kwargs):
         if weight_kwargs.pop('uniform', False):
             reg_loss = tf.reduce_sum(dp**2)
         else:
             reg_loss = tf.reduce_sum(dp**2, axis=(2, 3))
             reg_loss *= probs
             reg_loss = tf.reduce_sum(reg_loss)
-        weight = annealed_weight(**weight_kwargs)
+        weight = annealed_weight(step=step, **weight_kwargs)
         return reg_loss*weight
 
     def get_inference_loss(self, inference, labels):
@@ -355,14 +638,18 @@ class TemplateFfdBuilder(builder.ModelBuilder):
         losses.append(chamfer_loss)
 
         entropy_params = self.params.get('entropy_loss')
+        dp_reg_params = self.params.get('dp_regularization')
+        # shared by all annealed weights
+        step = get_float_step()
         if entropy_params is not None:
-            entropy_loss = self.get_entropy_loss(probs, **entropy_params)
+            entropy_loss = self.get_entropy_loss(
+                probs, step=step, **entropy_params)
             tf.summary.scalar('entropy', entropy_loss, family='sublosses')
             losses.append(entropy_loss)
 
-        dp_reg_params = self.params.get('dp_regularization')
         if dp_reg_params is not None:
-            dp_reg_loss = self.get_dp_reg_loss(probs, dp, **dp_reg_params)
+            dp_reg_loss = self.get_dp_reg_loss(
+                probs, dp, step=step, **dp_reg_params)
             tf.summary.scalar('dp_reg_loss', dp_reg_loss, family='sublosses')
             losses.append(dp_reg_loss)
 
@@ -374,6 +661,13 @@ class TemplateFfdBuilder(builder.ModelBuilder):
         """Get the train operation."""
         optimizer = tf.train.AdamOptimizer(
             learning_rate=self.params.get('learning_rate', 1e-3))
+        if self.params.get('mixed_precision', False):
+            # float16 conv/dense ops with dynamic loss scaling. Batched
+            # matmuls are kept in float32 by `scripts/train.py`, which sets
+            # the (process-global) rewrite blacklist before training.
+            optimizer = \
+                tf.train.experimental.enable_mixed_precision_graph_rewrite(
+                    optimizer)
         return optimizer.minimize(loss, step)
 
     @property
@@ -393,6 +687,46 @@ class TemplateFfdBuilder(builder.ModelBuilder):
     def n_samples(self):
         return self.params.get('n_samples', 16384)
 
+    @property
+    def shuffle_buffer_size(self):
+        return self.params.get('shuffle_buffer_size', 1024)
+
+    @property
+    def image_stats(self):
+        """
+        (mean, std) used to standardize images, or None.
+
+        None corresponds to `tf.image.per_image_standardization`, used unless
+        `'image_standardization': 'dataset'` is set in params.
+        """
+        # None is a valid value, so track whether stats have been loaded
+        if not self._image_stats_loaded:
+            self._image_stats = self._get_image_stats()
+            self._image_stats_loaded = True
+        return self._image_stats
+
+    def _get_image_stats(self):
+        standardization = self.params.get('image_standardization', 'per_image')
+        if standardization == 'per_image':
+            return None
+        elif standardization == 'dataset':
+            from .data import get_image_stats
+            return get_image_stats(
+                self.render_config, self.view_index, self.cat_id)
+        else:
+            raise ValueError(
+                'Unrecognized image_standardization value in params: %s'
+                % standardization)
+
+    def standardize_image(self, image):
+        """Standardize a uint8 image consistently with training inputs."""
+        return standardize_image(image, self.image_stats)
+
+    @property
+    def prefetch_device(self):
+        """Device to prefetch input batches to, e.g. '/gpu:0', or None."""
+        return self.params.get('prefetch_device')
+
     def get_dataset(self, mode, repeat=None):
         cat_id = self.cat_id
         if isinstance(cat_id, (list, tuple)):
@@ -410,12 +744,39 @@ class TemplateFfdBuilder(builder.ModelBuilder):
 
         dataset = get_dataset(
             render_config, view_index, n_samples, n_resamples, cat_id,
-            example_ids, shuffle=shuffle, repeat=repeat, batch_size=batch_size)
+            example_ids, mode, shuffle=shuffle, repeat=repeat,
+            batch_size=batch_size,
+            shuffle_buffer_size=self.shuffle_buffer_size,
+            prefetch_device=self.prefetch_device,
+            image_stats=self.image_stats)
         return dataset
 
     def get_inputs(self, mode, repeat=None):
         dataset = self.get_dataset(mode, repeat=repeat)
-        return dataset.make_one_shot_iterator().get_next()
+        device = self.prefetch_device
+        if device is None:
+            return dataset.make_one_shot_iterator().get_next()
+        # datasets copied to a device don't support one-shot iterators.
+        # The initializer is run by `IteratorInitializerHook`, which is
+        # added to estimator specs by `get_estimator_spec`.
+        with tf.device(device):
+            iterator = dataset.make_initializable_iterator()
+            inputs = iterator.get_next()
+        tf.add_to_collection(ITERATOR_INITIALIZERS, iterator.initializer)
+        return inputs
+
+    def get_estimator_spec(self, features, labels, mode, config=None):
+        spec = super(TemplateFfdBuilder, self).get_estimator_spec(
+            features, labels, mode, config=config)
+        if self.prefetch_device is None:
+            return spec
+        key = {
+            tf.estimator.ModeKeys.TRAIN: 'training_hooks',
+            tf.estimator.ModeKeys.EVAL: 'evaluation_hooks',
+            tf.estimator.ModeKeys.PREDICT: 'prediction_hooks',
+        }[mode]
+        hooks = tuple(getattr(spec, key)) + (IteratorInitializerHook(),)
+        return spec._replace(**{key: hooks})
 
     def vis_example_data(self, feature_data, label_data):
         import matplotlib.pyplot as plt
@@ -446,9 +807,10 @@ class TemplateFfdBuilder(builder.ModelBuilder):
         cat_id = self.cat_id
         if not isinstance(cat_id, (list, tuple)):
             cat_id = [cat_id]
-        with get_ffd_dataset(self.cat_id, self.n,
-                             edge_length_threshold=edge_length_threshold) as d:
-            cat_ids, example_ids, bs, ps = zip(*self.get_ffd_data(d))
+        cat_ids, example_ids, bs, ps = zip(
+            *self.get_mesh_ffd_data(edge_length_threshold))
+        bs = stack_if_uniform(bs)
+        ps = np.stack(ps)
         with get_template_mesh_dataset(cat_id, edge_length_threshold) as \
                 mesh_dataset:
             all_faces = []
@@ -474,10 +836,13 @@ class TemplateFfdBuilder(builder.ModelBuilder):
 
     def get_prediction_to_top_k_mesh_fn(
             self, edge_length_threshold=None, top_k=2):
+        if top_k < 1:
+            raise ValueError('top_k must be at least 1, got %s' % top_k)
         cat_id = self.cat_id
-        with get_ffd_dataset(cat_id, self.n, edge_length_threshold) \
-                as ffd_dataset:
-            cat_ids, example_ids, bs, ps = zip(*self.get_ffd_data(ffd_dataset))
+        cat_ids, example_ids, bs, ps = zip(
+            *self.get_mesh_ffd_data(edge_length_threshold))
+        bs = stack_if_uniform(bs)
+        ps = np.stack(ps)
         with get_template_mesh_dataset(cat_id, edge_length_threshold) as \
                 mesh_dataset:
             all_faces = []
@@ -495,17 +860,18 @@ class TemplateFfdBuilder(builder.ModelBuilder):
                 original_vertices=all_vertices[i])
 
         def transform_predictions(probs, dp):
-            ks = probs.argsort()[-3:][::-1]
+            k = min(top_k, probs.shape[0])
+            ks = np.argpartition(probs, -k)[-k:]
+            ks = ks[np.argsort(-probs[ks])]
             return [get_deformed_mesh(k, dp) for k in ks]
 
         return transform_predictions
 
     def get_prediction_to_cloud_fn(self, n_samples=None):
         from util3d.point_cloud import sample_points
-        with get_ffd_dataset(
-                self.cat_id, self.n, n_samples=self.n_ffd_samples) \
-                as ffd_dataset:
-            cat_ids, example_ids, bs, ps = zip(*self.get_ffd_data(ffd_dataset))
+        cat_ids, example_ids, bs, ps = zip(*self.get_ffd_data())
+        bs = stack_if_uniform(bs)
+        ps = np.stack(ps)
 
         def transform_predictions(probs, dp):
             i = np.argmax(probs)
@@ -580,10 +946,10 @@ class TemplateFfdBuilder(builder.ModelBuilder):
         faces = []
         original_segs = []
         original_seg_points = []
-        ffd_dataset = get_ffd_dataset(
-            cat_id, self.n, edge_length_threshold=edge_length_threshold)
-        with ffd_dataset:
-            cat_ids, example_ids, bs, ps = zip(*self.get_ffd_data(ffd_dataset))
+        cat_ids, example_ids, bs, ps = zip(
+            *self.get_mesh_ffd_data(edge_length_threshold))
+        bs = stack_if_uniform(bs)
+        ps = np.stack(ps)
 
         template_mesh_ds = get_template_mesh_dataset(
                 cat_id, edge_length_threshold=edge_length_threshold)
@@ -596,8 +962,11 @@ class TemplateFfdBuilder(builder.ModelBuilder):
                     template_mesh, seg_points, original_seg = ds[example_id]
                     v, f = (np.array(template_mesh[k])
                             for k in ('vertices', 'faces'))
-                    centroids = get_centroids(v, f)
-                    seg = original_seg[get_nn(seg_points, centroids)]
+                    # each template is labelled from its own annotated
+                    # point cloud, so there is no tree to share between
+                    # templates. Centroids are queried in a single
+                    # multi-threaded batch per template.
+                    seg = get_face_labels(v, f, seg_points, original_seg)
                 else:
                     f = None
                     seg = None
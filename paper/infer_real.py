@@ -60,7 +60,7 @@ def get_inference(model_id, example_id, ext='png', edge_length_threshold=0.02):
         # else:
         #     raise ValueError('ext must be in ("png", "jpg")')
         image.set_shape((192, 256, 3))
-        image = tf.image.per_image_standardization(image)
+        image = builder.standardize_image(image)
         example_id = tf.expand_dims(example_id, axis=0)
         image = tf.expand_dims(image, axis=0)
         return dict(example_id=example_id, image=image)
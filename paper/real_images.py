@@ -25,7 +25,7 @@ def save():
     graph = tf.Graph()
     with graph.as_default():
         image = tf.placeholder(shape=(192, 256, 3), dtype=tf.uint8)
-        std_image = tf.image.per_image_standardization(image)
+        std_image = builder.standardize_image(image)
         std_image = tf.expand_dims(std_image, axis=0)
         example_id = tf.constant(['blah'], dtype=tf.string)
         spec = builder.get_estimator_spec(
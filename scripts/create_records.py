@@ -0,0 +1,34 @@
+#!/usr/bin/python
+
+
+def create_records(model_id, modes, n_shards=8, overwrite=False):
+    from template_ffd.model import get_builder
+    from template_ffd.model.data import create_records
+    from template_ffd.data.ids import get_example_ids
+    builder = get_builder(model_id)
+    cat_ids = builder.cat_id
+    if isinstance(cat_ids, str):
+        cat_ids = [cat_ids]
+    for mode in modes:
+        for cat_id in cat_ids:
+            create_records(
+                builder.render_config, builder.view_index, builder.n_samples,
+                cat_id, get_example_ids(cat_id, mode), mode,
+                n_shards=n_shards, overwrite=overwrite)
+    if builder.params.get('image_standardization') == 'dataset':
+        # calculated and cached on first access
+        builder.image_stats
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model_id', help='id of model defined in params')
+    parser.add_argument(
+        '-m', '--modes', default=['train', 'eval'], nargs='*')
+    parser.add_argument('-n', '--n_shards', default=8, type=int)
+    parser.add_argument('-o', '--overwrite', action='store_true')
+
+    args = parser.parse_args()
+    create_records(args.model_id, args.modes, args.n_shards, args.overwrite)
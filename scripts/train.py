@@ -1,11 +1,27 @@
 #!/usr/bin/python
 
 
+def _blacklist_batch_matmul():
+    # The FFD deformation (a batched matmul) feeds the chamfer loss, so is
+    # kept in float32 under the mixed precision graph rewrite. This is read
+    # from the environment, so affects every graph in the process. Dense
+    # layers use MatMul so are unaffected.
+    import os
+    key = 'TF_AUTO_MIXED_PRECISION_GRAPH_REWRITE_BLACKLIST_ADD'
+    blacklist = [op for op in os.environ.get(key, '').split(',') if op]
+    for op in ('BatchMatMul', 'BatchMatMulV2'):
+        if op not in blacklist:
+            blacklist.append(op)
+    os.environ[key] = ','.join(blacklist)
+
+
 def train(model_id, max_steps):
     import tensorflow as tf
     from template_ffd.model import get_builder
     tf.logging.set_verbosity(tf.logging.INFO)
     builder = get_builder(model_id)
+    if builder.params.get('mixed_precision', False):
+        _blacklist_batch_matmul()
     builder.initialize_variables()
     if max_steps is None:
         max_steps = builder.default_max_steps
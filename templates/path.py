@@ -23,6 +23,13 @@ def get_ffd_group_path(
                         '%s.hdf5' % cat_id)
 
 
+def get_ffd_cache_path(n, key):
+    d = os.path.join(templates_dir, '_ffd', str(n), 'cache')
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    return os.path.join(d, '%s.npz' % key)
+
+
 def get_split_mesh_group_dir(edge_length_threshold):
     d = os.path.join(templates_dir, '_split_mesh', str(edge_length_threshold))
     if not os.path.isdir(d):